@@ -11,20 +11,21 @@ Provides:
 - GET /api/health - Health check
 """
 
+import asyncio
 import os
 import time
-import jwt
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from pydantic import BaseModel
 from dotenv import load_dotenv
 
 from arduino_tools import (
     list_arduino_boards,
     write_sketch,
-    compile_sketch,
-    upload_sketch,
+    compile_and_upload_sketch,
 )
+from stream_tokens import encode_jwt, hs256_key
 
 load_dotenv()
 
@@ -34,6 +35,15 @@ app = FastAPI(title="ArduinoVision API", version="1.0.0")
 STREAM_API_KEY = os.getenv("STREAM_API_KEY", "")
 STREAM_API_SECRET = os.getenv("STREAM_API_SECRET", "")
 
+# HS256 key prepared once, so token issuing skips per-call key setup
+_TOKEN_KEY = hs256_key(STREAM_API_SECRET)
+
+# Issued tokens per user_id: (token, exp). Reused until close to expiry so
+# repeat /api/token calls skip the HMAC signing.
+_TOKEN_CACHE: dict[str, tuple[str, int]] = {}
+_TOKEN_CACHE_MAX = 4096
+_TOKEN_MIN_REMAINING = 300  # re-issue when less than 5 minutes remain
+
 # CORS for frontend
 app.add_middleware(
     CORSMiddleware,
@@ -43,6 +53,10 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Compress larger payloads such as /api/boards details; small responses
+# like /api/health stay uncompressed
+app.add_middleware(GZipMiddleware, minimum_size=500)
+
 
 class TokenRequest(BaseModel):
     user_id: str
@@ -55,12 +69,39 @@ class UploadRequest(BaseModel):
     sketch_name: str = "frontend_sketch"
 
 
-@app.get("/api/health")
+# Response models: with these declared, FastAPI serializes responses
+# straight to JSON bytes via Pydantic instead of through jsonable_encoder
+class HealthResponse(BaseModel):
+    status: str
+    stream_configured: bool
+
+
+class StreamConfigResponse(BaseModel):
+    apiKey: str
+
+
+class TokenResponse(BaseModel):
+    token: str
+    user_id: str
+
+
+class BoardsResponse(BaseModel):
+    boards: list[str]
+    details: list[dict]
+
+
+class UploadResponse(BaseModel):
+    success: bool
+    message: str
+    sketch_path: str
+
+
+@app.get("/api/health", response_model=HealthResponse)
 async def health():
     return {"status": "ok", "stream_configured": bool(STREAM_API_KEY and STREAM_API_SECRET)}
 
 
-@app.get("/api/stream-config")
+@app.get("/api/stream-config", response_model=StreamConfigResponse)
 async def get_stream_config():
     """Get Stream API key (public) for frontend."""
     if not STREAM_API_KEY:
@@ -68,29 +109,40 @@ async def get_stream_config():
     return {"apiKey": STREAM_API_KEY}
 
 
-@app.post("/api/token")
+@app.post("/api/token", response_model=TokenResponse)
 async def generate_token(req: TokenRequest):
     """Generate a Stream user token for video calls."""
     if not STREAM_API_SECRET:
         raise HTTPException(status_code=500, detail="STREAM_API_SECRET not configured")
     
+    now = int(time.time())
+    cached = _TOKEN_CACHE.get(req.user_id)
+    if cached and cached[1] - now > _TOKEN_MIN_REMAINING:
+        return {"token": cached[0], "user_id": req.user_id}
+
     # Create JWT token for Stream
     # Stream tokens use HS256 algorithm
-    now = int(time.time())
+    exp = now + 3600 * 24  # 24 hour expiry
     payload = {
         "user_id": req.user_id,
         "iat": now,
-        "exp": now + 3600 * 24,  # 24 hour expiry
+        "exp": exp,
     }
     
-    token = jwt.encode(payload, STREAM_API_SECRET, algorithm="HS256")
+    token = encode_jwt(payload, _TOKEN_KEY)
+
+    # Bound the cache: drop the oldest entry (dicts keep insertion order)
+    if len(_TOKEN_CACHE) >= _TOKEN_CACHE_MAX and req.user_id not in _TOKEN_CACHE:
+        del _TOKEN_CACHE[next(iter(_TOKEN_CACHE))]
+    _TOKEN_CACHE[req.user_id] = (token, exp)
     return {"token": token, "user_id": req.user_id}
 
 
-@app.get("/api/boards")
-async def get_boards():
-    """List connected Arduino boards."""
-    boards = list_arduino_boards()
+@app.get("/api/boards", response_model=BoardsResponse)
+async def get_boards(force: bool = False):
+    """List connected Arduino boards. Pass ?force=1 to bypass the cache."""
+    # arduino-cli runs in a worker thread so the event loop stays free
+    boards = await asyncio.to_thread(list_arduino_boards, force)
     # Return just the ports for the dropdown
     ports = [b["port"] for b in boards]
     return {
@@ -99,27 +151,19 @@ async def get_boards():
     }
 
 
-@app.post("/api/upload")
+@app.post("/api/upload", response_model=UploadResponse)
 async def upload_code(req: UploadRequest):
-    """Upload code to Arduino - write, compile, upload."""
+    """Upload code to Arduino - write, then compile + upload."""
     try:
         # Write sketch
-        sketch_path = write_sketch(req.code, req.sketch_name)
-        
-        # Compile
-        compile_result = compile_sketch(sketch_path, req.board_fqbn)
-        if not compile_result["success"]:
-            raise HTTPException(
-                status_code=400,
-                detail=f"Compilation failed: {compile_result['errors']}"
-            )
+        sketch_path = await asyncio.to_thread(write_sketch, req.code, req.sketch_name)
         
-        # Upload
-        upload_result = upload_sketch(sketch_path, req.board, req.board_fqbn)
-        if not upload_result["success"]:
+        # Compile + upload in one arduino-cli run
+        result = await compile_and_upload_sketch(sketch_path, req.board, req.board_fqbn)
+        if not result["success"]:
             raise HTTPException(
                 status_code=400,
-                detail=f"Upload failed: {upload_result['errors']}"
+                detail=f"Compile/upload failed: {result['errors']}"
             )
         
         return {
@@ -137,4 +181,19 @@ async def upload_code(req: UploadRequest):
 if __name__ == "__main__":
     import uvicorn
     port = int(os.environ.get("API_PORT", 8001))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    # Single process by default. API_WORKERS > 1 is opt-in: every worker
+    # keeps its own token and board caches, and workers don't coordinate
+    # sketch writes, builds or serial port access with each other.
+    # Multiple workers need the app as an import string so each process
+    # can load it.
+    workers = int(os.environ.get("API_WORKERS", 1))
+    # "auto" picks uvloop + httptools (uvicorn[standard]) when installed and
+    # falls back to asyncio + h11 instead of failing at startup
+    uvicorn.run(
+        "api_server:app" if workers > 1 else app,
+        host="0.0.0.0",
+        port=port,
+        workers=workers,
+        loop="auto",
+        http="auto",
+    )
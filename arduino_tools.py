@@ -3,46 +3,111 @@ Arduino Tools for ArduinoVision Agent
 
 Provides functions to interact with Arduino boards programmatically:
 - Detect connected boards
-- Write, compile, and upload sketches
+- Write, compile, and upload sketches (separately or in one step)
 - Read serial output
 """
 
 import subprocess
 import asyncio
-import json
+import hashlib
 import os
-import stat
+import shutil
+import string
+import tempfile
+import time
 from pathlib import Path
-from typing import Optional
+from typing import Callable, Optional
 
-try:
-    import serial
-    import serial.tools.list_ports
-    HAS_SERIAL = True
-except ImportError:
-    HAS_SERIAL = False
-    print("Warning: pyserial not installed. Serial functions will not work.")
+import orjson
+
+# pyserial is imported on first use (see _import_serial) so processes that
+# never touch a serial port don't pay for loading it
+_serial = None
+HAS_SERIAL: Optional[bool] = None  # unknown until the first import attempt
+
+# arduino-cli resolved once, so each launch execs a fixed path instead of
+# searching PATH; falls back to the bare name (FileNotFoundError if missing)
+ARDUINO_CLI = shutil.which("arduino-cli") or "arduino-cli"
+
+# close_fds=False (with an absolute ARDUINO_CLI and no preexec_fn/cwd) lets
+# CPython launch arduino-cli via posix_spawn instead of fork+exec, avoiding a
+# page-table copy of this (possibly large) process. Python's own fds are
+# non-inheritable by default, so nothing extra leaks into the child.
+# Only the board scan's subprocess.run uses it: both servers run on uvloop
+# (uvicorn[standard]), whose asyncio subprocesses are spawned by libuv.
+_SPAWN_KWARGS = {"close_fds": False}
 
 # Directory for storing sketches
 SKETCH_DIR = Path(__file__).parent / "sketches"
 SKETCH_DIR.mkdir(exist_ok=True)
 
+# Characters stripped from sketch names: everything in ASCII except letters,
+# digits and underscore (non-ASCII is dropped separately in write_sketch)
+_SAFE_NAME_CHARS = frozenset(string.ascii_letters + string.digits + "_")
+_SAFE_NAME_DELETE = {i: None for i in range(128) if chr(i) not in _SAFE_NAME_CHARS}
+
+# Persistent build locations so arduino-cli can reuse the compiled core and
+# unchanged objects instead of rebuilding from scratch on every compile
+_BUILD_CACHE = str(Path(tempfile.gettempdir()) / "arduino_build_cache")
+_BUILD_DIR = SKETCH_DIR / ".build"
+
+# Board detection shells out to arduino-cli, which is slow; results are
+# reused for a short while since they only change on plug/unplug.
+BOARDS_CACHE_TTL = 2.0  # seconds
+_boards_cache: Optional[tuple[float, list[dict]]] = None
+
+# Build dir -> lock, see _build_lock
+_build_locks: dict[str, asyncio.Lock] = {}
+
+# Ports already found writable: port -> (st_ino, st_dev) of the device node
+_port_ok_cache: dict[str, tuple[int, int]] = {}
+
+# Known Arduino / clone USB-to-serial VIDs
+ARDUINO_VIDS = frozenset({
+    0x2341,  # Arduino LLC (official)
+    0x1a86,  # QinHeng CH340/CH341 (common in clones)
+    0x0403,  # FTDI
+    0x10c4,  # Silicon Labs CP210x
+    0x067b,  # Prolific PL2303
+})
+
+
+def _import_serial():
+    """Import pyserial on first use; returns the module, or None if missing."""
+    global _serial, HAS_SERIAL
+    if HAS_SERIAL is None:
+        try:
+            import serial
+            import serial.tools.list_ports
+            _serial = serial
+            HAS_SERIAL = True
+        except ImportError:
+            HAS_SERIAL = False
+            print("Warning: pyserial not installed. Serial functions will not work.")
+    return _serial
 
-def fix_port_permissions(port: str) -> dict:
+
+async def fix_port_permissions(port: str) -> dict:
     """
     Attempt to fix serial port permissions via sudo chmod.
     Works on Linux/WSL where the user may not be in the dialout/uucp group.
+    Runs as an asyncio subprocess so a slow sudo doesn't stall the event loop.
 
     Returns a dict with success status and message.
     """
     try:
-        result = subprocess.run(
-            ["sudo", "-n", "chmod", "a+rw", port],
-            capture_output=True,
-            text=True,
-            timeout=5,
+        proc = await asyncio.create_subprocess_exec(
+            "sudo", "-n", "chmod", "a+rw", port,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL,
         )
-        if result.returncode == 0:
+        try:
+            returncode = await asyncio.wait_for(proc.wait(), timeout=5)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            raise
+        if returncode == 0:
             return {"success": True, "message": f"Fixed permissions on {port}"}
         return {
             "success": False,
@@ -54,64 +119,83 @@ def fix_port_permissions(port: str) -> dict:
                 f"  3. Udev rule: sudo cp 99-usb-serial.rules /etc/udev/rules.d/ && sudo udevadm control --reload-rules && sudo udevadm trigger"
             ),
         }
+    except asyncio.TimeoutError:
+        return {"success": False, "message": "sudo chmod timed out after 5 seconds."}
     except Exception as e:
         return {"success": False, "message": str(e)}
 
 
 def check_port_accessible(port: str) -> bool:
-    """Return True if the process can open the serial port for writing."""
+    """
+    Return True if the process can open the serial port for writing.
+
+    A positive result is remembered per device node (inode, device), so
+    replugging the board — which creates a new node — rechecks it.
+    """
     try:
-        mode = os.stat(port).st_mode
-        # Check world-writable, or owner/group write where uid/gid matches
-        uid = os.getuid()
-        gids = os.getgroups()
         st = os.stat(port)
-        owner_write = (st.st_uid == uid) and bool(st.st_mode & stat.S_IWUSR)
-        group_write = (st.st_gid in gids) and bool(st.st_mode & stat.S_IWGRP)
-        world_write = bool(st.st_mode & stat.S_IWOTH)
-        return owner_write or group_write or world_write
-    except Exception:
+        key = (st.st_ino, st.st_dev)
+        if _port_ok_cache.get(port) == key:
+            return True
+        if os.access(port, os.W_OK):
+            _port_ok_cache[port] = key
+            return True
         return False
+    except (OSError, ValueError):  # ValueError: embedded NUL in the port
+        return False
+
+
+_PERM_HINT_TMPL = (
+    "Permission denied on {port}.\n"
+    "Fix options (run in WSL terminal):\n"
+    "  Quick (resets on unplug):  sudo chmod a+rw {port}\n"
+    "  Permanent (needs re-login): sudo usermod -a -G uucp $USER\n"
+    "  Permanent (udev rule):     sudo cp 99-usb-serial.rules /etc/udev/rules.d/ && sudo udevadm control --reload-rules && sudo udevadm trigger"
+)
 
 
 def _permission_denied_hint(port: str) -> str:
-    return (
-        f"Permission denied on {port}.\n"
-        f"Fix options (run in WSL terminal):\n"
-        f"  Quick (resets on unplug):  sudo chmod a+rw {port}\n"
-        f"  Permanent (needs re-login): sudo usermod -a -G uucp $USER\n"
-        f"  Permanent (udev rule):     sudo cp 99-usb-serial.rules /etc/udev/rules.d/ && sudo udevadm control --reload-rules && sudo udevadm trigger"
-    )
+    return _PERM_HINT_TMPL.format(port=port)
 
 
-def list_arduino_boards() -> list[dict]:
+def list_arduino_boards(force: bool = False) -> list[dict]:
     """
     Detect connected Arduino boards.
+
+    Results are cached for BOARDS_CACHE_TTL seconds.
+
+    Args:
+        force: Bypass the cache and rescan
     
     Returns:
         List of dictionaries with board info (port, description, fqbn)
     """
-    arduino_boards = []
-    
-    # Known Arduino / clone USB-to-serial VIDs
-    ARDUINO_VIDS = {
-        0x2341,  # Arduino LLC (official)
-        0x1a86,  # QinHeng CH340/CH341 (common in clones)
-        0x0403,  # FTDI
-        0x10c4,  # Silicon Labs CP210x
-        0x067b,  # Prolific PL2303
-    }
+    global _boards_cache
+    now = time.monotonic()
+    if not force and _boards_cache and now - _boards_cache[0] < BOARDS_CACHE_TTL:
+        return _boards_cache[1]
+
+    boards = _scan_arduino_boards()
+    _boards_cache = (now, boards)
+    return boards
+
+
+def _scan_arduino_boards() -> list[dict]:
+    """Run PySerial and arduino-cli board detection (uncached)."""
+    # Keyed by port; the first method to report a port wins
+    arduino_boards: dict[str, dict] = {}
 
     # Method 1: PySerial detection
-    if HAS_SERIAL:
+    serial = _import_serial()
+    if serial:
         ports = serial.tools.list_ports.comports()
         for port in ports:
-            is_arduino = (
-                (port.vid in ARDUINO_VIDS)
-                or (port.description and "arduino" in port.description.lower())
-            )
+            is_arduino = port.vid in ARDUINO_VIDS
+            if not is_arduino and port.description:
+                desc = port.description
+                is_arduino = "arduino" in desc or "Arduino" in desc  # cheaper than .lower()
             if is_arduino:
-                arduino_boards.append({
+                arduino_boards.setdefault(port.device, {
                     "port": port.device,
                     "description": port.description or "Unknown Arduino",
                     "hwid": port.hwid,
@@ -124,13 +208,14 @@ def list_arduino_boards() -> list[dict]:
     # Clones often have no matching_boards but are still programmable
     try:
         result = subprocess.run(
-            ["arduino-cli", "board", "list", "--format", "json"],
+            [ARDUINO_CLI, "board", "list", "--format", "json"],
             capture_output=True,
-            text=True,
-            timeout=10
+            timeout=10,
+            **_SPAWN_KWARGS,
         )
         if result.returncode == 0:
-            data = json.loads(result.stdout)
+            # stdout stays bytes; orjson parses it without a utf-8 decode pass
+            data = orjson.loads(result.stdout)
             for detected in data.get("detected_ports", []):
                 port_info = detected.get("port", {})
                 address = port_info.get("address", "")
@@ -142,7 +227,7 @@ def list_arduino_boards() -> list[dict]:
                     continue
                 if detected.get("matching_boards"):
                     board_info = detected["matching_boards"][0]
-                    arduino_boards.append({
+                    arduino_boards.setdefault(address, {
                         "port": address,
                         "board_name": board_info.get("name", "Unknown Board"),
                         "fqbn": board_info.get("fqbn", "arduino:avr:uno"),
@@ -150,7 +235,7 @@ def list_arduino_boards() -> list[dict]:
                     })
                 else:
                     # Clone or unrecognised board — include with default FQBN
-                    arduino_boards.append({
+                    arduino_boards.setdefault(address, {
                         "port": address,
                         "board_name": "Arduino (clone/unrecognised)",
                         "fqbn": "arduino:avr:uno",
@@ -160,18 +245,10 @@ def list_arduino_boards() -> list[dict]:
         print("Warning: arduino-cli not found. Install it for full functionality.")
     except subprocess.TimeoutExpired:
         print("Warning: arduino-cli timed out")
-    except json.JSONDecodeError:
+    except orjson.JSONDecodeError:
         print("Warning: Could not parse arduino-cli output")
     
-    # Deduplicate by port
-    seen_ports = set()
-    unique_boards = []
-    for board in arduino_boards:
-        if board["port"] not in seen_ports:
-            seen_ports.add(board["port"])
-            unique_boards.append(board)
-    
-    return unique_boards
+    return list(arduino_boards.values())
 
 
 def write_sketch(code: str, name: str = "sketch") -> str:
@@ -188,7 +265,10 @@ def write_sketch(code: str, name: str = "sketch") -> str:
         Path to the sketch folder (for use with compile/upload)
     """
     # Sanitize name
-    safe_name = "".join(c for c in name if c.isalnum() or c == "_").lower()
+    safe_name = name.translate(_SAFE_NAME_DELETE).lower()
+    if not safe_name.isascii():
+        # arduino-cli only accepts ASCII sketch names
+        safe_name = safe_name.encode("ascii", "ignore").decode()
     if not safe_name:
         safe_name = "sketch"
     
@@ -196,49 +276,254 @@ def write_sketch(code: str, name: str = "sketch") -> str:
     sketch_folder.mkdir(exist_ok=True)
     
     sketch_file = sketch_folder / f"{safe_name}.ino"
-    sketch_file.write_text(code)
+    # Leave an identical file untouched so its mtime doesn't invalidate
+    # arduino-cli's build cache
+    new = code.encode()
+    if sketch_file.exists() and sketch_file.read_bytes() == new:
+        return str(sketch_folder)
+    sketch_file.write_bytes(new)
     
     return str(sketch_folder)
 
 
-def compile_sketch(sketch_path: str, fqbn: str = "arduino:avr:uno") -> dict:
+async def _run_arduino_cli(
+    args: list[str],
+    timeout: float,
+    capture_stdout: bool = True,
+    on_line: Optional[Callable[[str], None]] = None,
+) -> tuple[int, bytes, bytes]:
+    """
+    Run arduino-cli as an asyncio subprocess without blocking the event loop.
+
+    Args:
+        args: Arguments after "arduino-cli"
+        timeout: Seconds before the process is killed
+        capture_stdout: If False, stdout goes to /dev/null and b"" is returned
+        on_line: Called with each stderr line as soon as it is printed
+
+    Returns:
+        Tuple of (returncode, stdout, stderr) with raw output bytes
+
+    Raises:
+        FileNotFoundError: arduino-cli is not installed
+        asyncio.TimeoutError: the process did not finish in time (it is killed)
+        asyncio.CancelledError: the caller was cancelled (the process is killed)
+    """
+    proc = await asyncio.create_subprocess_exec(
+        ARDUINO_CLI, *args,
+        stdout=asyncio.subprocess.PIPE if capture_stdout else asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE,
+    )
+
+    async def collect() -> tuple[Optional[bytes], bytes]:
+        if on_line is None:
+            return await proc.communicate()
+
+        async def stream_stderr() -> bytes:
+            buf = bytearray()
+            async for line in proc.stderr:
+                buf.extend(line)
+                text = line.decode("utf-8", errors="replace").rstrip()
+                if text:
+                    on_line(text)
+            return bytes(buf)
+
+        async def read_stdout() -> Optional[bytes]:
+            return await proc.stdout.read() if capture_stdout else None
+
+        stdout, stderr = await asyncio.gather(read_stdout(), stream_stderr())
+        await proc.wait()
+        return stdout, stderr
+
+    try:
+        stdout, stderr = await asyncio.wait_for(collect(), timeout=timeout)
+    finally:
+        # Timed out or the caller was cancelled: don't leave arduino-cli
+        # running (possibly mid-flash) after we stop waiting for it
+        if proc.returncode is None:
+            try:
+                proc.kill()
+            except ProcessLookupError:
+                pass  # exited just now; wait() below reaps it
+            await asyncio.shield(proc.wait())
+    return proc.returncode, stdout or b"", stderr
+
+
+def _sketch_dir(sketch_path: str) -> Path:
+    """The sketch folder, also when sketch_path names its .ino file (arduino-cli accepts both)."""
+    path = Path(sketch_path)
+    return path.parent if path.suffix in (".ino", ".pde") else path
+
+
+def _build_path(sketch_path: str) -> str:
+    """
+    Per-sketch build directory, shared by compile (output) and upload (input).
+
+    Keyed by the resolved folder path (like arduino-cli's default build
+    path), so /x/blink and /y/blink never share artifacts.
+    """
+    folder = _sketch_dir(sketch_path).resolve()
+    key = hashlib.blake2b(str(folder).encode(), digest_size=8).hexdigest()
+    return str(_BUILD_DIR / f"{folder.name}-{key}")
+
+
+def _build_lock(sketch_path: str) -> asyncio.Lock:
+    """
+    Lock serializing compiles and uploads that share a build directory.
+
+    Only covers this process: separate processes (e.g. several uvicorn
+    workers) building the same sketch are not serialized.
+    """
+    return _build_locks.setdefault(_build_path(sketch_path), asyncio.Lock())
+
+
+# Compile skipping: the build dir holds a stamp with a digest of the sources
+# its artifacts were built from. The digest covers the FQBN and the sketch
+# sources only, not the installed core/library versions or the arduino-cli
+# version; after upgrading those, delete sketches/.build (or change the
+# sketch) to force a rebuild.
+_SOURCE_SUFFIXES = frozenset({".ino", ".pde", ".cpp", ".c", ".h", ".hpp", ".S"})
+
+
+def _source_digest(sketch_path: str, fqbn: str) -> Optional[str]:
+    """
+    BLAKE2b digest of the FQBN plus the sketch sources (blocking file I/O).
+
+    Hashes the top-level source files and everything under src/, which is
+    what arduino-cli compiles. Returns None when sketch_path is not a sketch
+    folder (no <name>.ino/.pde), so arbitrary directories are never walked.
+
+    Raises:
+        OSError: a source file could not be read
+    """
+    root = _sketch_dir(sketch_path)
+    if not any((root / f"{root.name}{ext}").is_file() for ext in (".ino", ".pde")):
+        return None
+    files = [f for f in root.iterdir() if f.suffix in _SOURCE_SUFFIXES and f.is_file()]
+    src = root / "src"
+    if src.is_dir():
+        files.extend(f for f in src.rglob("*") if f.is_file())
+    h = hashlib.blake2b(fqbn.encode(), digest_size=16)
+    for f in sorted(files):
+        h.update(f.relative_to(root).as_posix().encode() + b"\0")
+        h.update(f.read_bytes())
+    return h.hexdigest()
+
+
+def _build_stamp(sketch_path: str) -> Path:
+    """File in the build dir recording which sources its artifacts came from."""
+    return Path(_build_path(sketch_path)) / ".source_digest"
+
+
+def _check_build(sketch_path: str, fqbn: str) -> tuple[Optional[str], bool]:
+    """
+    Digest the sources and compare with the build stamp (blocking file I/O).
+
+    A stale stamp is removed, so an interrupted rebuild isn't trusted later.
+    Sources that can't be hashed count as not current; arduino-cli then
+    reports the actual problem.
+
+    Returns:
+        Tuple of (digest or None, whether the build dir is current for it)
+    """
+    stamp = _build_stamp(sketch_path)
+    try:
+        digest = _source_digest(sketch_path, fqbn)
+        if digest is not None and stamp.exists() and stamp.read_text() == digest:
+            return digest, True
+        stamp.unlink(missing_ok=True)
+    except OSError:
+        return None, False
+    return digest, False
+
+
+def _write_build_stamp(sketch_path: str, fqbn: str, digest: Optional[str]) -> None:
+    """
+    Stamp the build dir with `digest`, the sources arduino-cli was started on.
+
+    Sources rewritten while it ran (another write_sketch to the same name)
+    may or may not be in the artifacts, so the stamp is skipped then and
+    the next compile rebuilds. It is also skipped if they can't be hashed.
+    """
+    if digest is None:
+        return
+    try:
+        if _source_digest(sketch_path, fqbn) != digest:
+            return
+        stamp = _build_stamp(sketch_path)
+        stamp.parent.mkdir(parents=True, exist_ok=True)
+        stamp.write_text(digest)
+    except OSError:
+        pass  # no stamp just means the next compile doesn't skip
+
+
+async def compile_sketch(
+    sketch_path: str,
+    fqbn: str = "arduino:avr:uno",
+    on_line: Optional[Callable[[str], None]] = None,
+    jobs: int = 0,
+) -> dict:
     """
     Compile an Arduino sketch.
     
     Args:
         sketch_path: Path to the sketch folder (containing .ino file)
         fqbn: Fully Qualified Board Name (e.g., "arduino:avr:uno")
+        on_line: Optional callback for each stderr line while compiling
+        jobs: Parallel compiler processes for this build (0 = all cores)
     
     Returns:
         Dictionary with success status, output, and errors
     """
-    try:
-        result = subprocess.run(
-            ["arduino-cli", "compile", "--fqbn", fqbn, sketch_path],
-            capture_output=True,
-            text=True,
-            timeout=120  # Compilation can take a while
-        )
-        return {
-            "success": result.returncode == 0,
-            "output": result.stdout,
-            "errors": result.stderr if result.returncode != 0 else None
-        }
-    except FileNotFoundError:
-        return {
-            "success": False,
-            "output": "",
-            "errors": "arduino-cli not found. Please install it first."
-        }
-    except subprocess.TimeoutExpired:
-        return {
-            "success": False,
-            "output": "",
-            "errors": "Compilation timed out after 120 seconds."
-        }
+    async with _build_lock(sketch_path):
+        # Identical sources already built for this board: nothing to do
+        digest, current = await asyncio.to_thread(_check_build, sketch_path, fqbn)
+        if current:
+            return {"success": True, "output": "", "errors": None}
+
+        try:
+            # Only stderr matters (on failure), so stdout is discarded unread
+            returncode, _, stderr = await _run_arduino_cli(
+                [
+                    "compile", "--fqbn", fqbn,
+                    "--build-cache-path", _BUILD_CACHE,
+                    "--build-path", _build_path(sketch_path),
+                    "--jobs", str(jobs),
+                    "--no-color",
+                    sketch_path,
+                ],
+                timeout=120,  # Compilation can take a while
+                capture_stdout=False,
+                on_line=on_line,
+            )
+            if returncode == 0:
+                await asyncio.to_thread(_write_build_stamp, sketch_path, fqbn, digest)
+                return {"success": True, "output": "", "errors": None}
+            return {
+                "success": False,
+                "output": "",
+                "errors": stderr.decode("utf-8", errors="replace"),
+            }
+        except FileNotFoundError:
+            return {
+                "success": False,
+                "output": "",
+                "errors": "arduino-cli not found. Please install it first."
+            }
+        except asyncio.TimeoutError:
+            return {
+                "success": False,
+                "output": "",
+                "errors": "Compilation timed out after 120 seconds."
+            }
 
 
-def upload_sketch(sketch_path: str, port: str, fqbn: str = "arduino:avr:uno") -> dict:
+async def upload_sketch(
+    sketch_path: str,
+    port: str,
+    fqbn: str = "arduino:avr:uno",
+    on_line: Optional[Callable[[str], None]] = None,
+) -> dict:
     """
     Upload a compiled sketch to an Arduino board.
     
@@ -246,14 +531,27 @@ def upload_sketch(sketch_path: str, port: str, fqbn: str = "arduino:avr:uno") ->
         sketch_path: Path to the sketch folder
         port: Serial port (e.g., "/dev/ttyUSB0" or "/dev/ttyACM0")
         fqbn: Fully Qualified Board Name
+        on_line: Optional callback for each stderr line (avrdude progress)
     
     Returns:
         Dictionary with success status, output, and errors
     """
+    # Don't flash a build dir that a compile is rewriting
+    async with _build_lock(sketch_path):
+        return await _upload_built(sketch_path, port, fqbn, on_line)
+
+
+async def _upload_built(
+    sketch_path: str,
+    port: str,
+    fqbn: str,
+    on_line: Optional[Callable[[str], None]] = None,
+) -> dict:
+    """upload_sketch body; the caller holds the build dir lock."""
     # Pre-flight: check port is accessible before even calling arduino-cli
     if not check_port_accessible(port):
         # Try auto-fix via sudo -n (works if NOPASSWD is configured)
-        fix = fix_port_permissions(port)
+        fix = await fix_port_permissions(port)
         if fix["success"]:
             pass  # proceed with the upload
         else:
@@ -264,14 +562,18 @@ def upload_sketch(sketch_path: str, port: str, fqbn: str = "arduino:avr:uno") ->
             }
 
     try:
-        result = subprocess.run(
-            ["arduino-cli", "upload", "-p", port, "--fqbn", fqbn, sketch_path],
-            capture_output=True,
-            text=True,
-            timeout=60
+        returncode, stdout, stderr = await _run_arduino_cli(
+            [
+                "upload", "-p", port, "--fqbn", fqbn,
+                "--input-dir", _build_path(sketch_path),
+                "--no-color",
+                sketch_path,
+            ],
+            timeout=60,
+            on_line=on_line,
         )
-        success = result.returncode == 0
-        errors = result.stderr if not success else None
+        success = returncode == 0
+        errors = stderr.decode("utf-8", errors="replace") if not success else None
 
         # Surface permission errors with actionable hint
         if not success and errors and "permission denied" in errors.lower():
@@ -279,7 +581,7 @@ def upload_sketch(sketch_path: str, port: str, fqbn: str = "arduino:avr:uno") ->
 
         return {
             "success": success,
-            "output": result.stdout,
+            "output": stdout.decode("utf-8", errors="replace"),
             "errors": errors,
         }
     except FileNotFoundError:
@@ -288,7 +590,7 @@ def upload_sketch(sketch_path: str, port: str, fqbn: str = "arduino:avr:uno") ->
             "output": "",
             "errors": "arduino-cli not found. Please install it first."
         }
-    except subprocess.TimeoutExpired:
+    except asyncio.TimeoutError:
         return {
             "success": False,
             "output": "",
@@ -296,6 +598,74 @@ def upload_sketch(sketch_path: str, port: str, fqbn: str = "arduino:avr:uno") ->
         }
 
 
+async def compile_and_upload_sketch(
+    sketch_path: str, port: str, fqbn: str = "arduino:avr:uno"
+) -> dict:
+    """
+    Compile and upload a sketch with a single `arduino-cli compile --upload`.
+
+    Saves the second arduino-cli process (and its core/FQBN setup) that a
+    separate compile_sketch + upload_sketch pair would spawn.
+
+    Args:
+        sketch_path: Path to the sketch folder
+        port: Serial port (e.g., "/dev/ttyUSB0" or "/dev/ttyACM0")
+        fqbn: Fully Qualified Board Name
+
+    Returns:
+        Dictionary with success status, output, and errors
+    """
+    async with _build_lock(sketch_path):
+        # Already built from these sources: only the upload is left to do
+        digest, current = await asyncio.to_thread(_check_build, sketch_path, fqbn)
+        if current:
+            return await _upload_built(sketch_path, port, fqbn)
+
+        # Pre-flight: same port check as upload_sketch
+        if not check_port_accessible(port):
+            fix = await fix_port_permissions(port)
+            if not fix["success"]:
+                return {
+                    "success": False,
+                    "output": "",
+                    "errors": _permission_denied_hint(port),
+                }
+
+        try:
+            returncode, _, stderr = await _run_arduino_cli(
+                [
+                    "compile", "--upload", "-p", port, "--fqbn", fqbn,
+                    "--build-cache-path", _BUILD_CACHE,
+                    "--build-path", _build_path(sketch_path),
+                    "--jobs", "0",
+                    "--no-color",
+                    sketch_path,
+                ],
+                timeout=180,  # compile (120s) + upload (60s) budget
+                capture_stdout=False,
+            )
+            if returncode == 0:
+                await asyncio.to_thread(_write_build_stamp, sketch_path, fqbn, digest)
+                return {"success": True, "output": "", "errors": None}
+
+            errors = stderr.decode("utf-8", errors="replace")
+            if "permission denied" in errors.lower():
+                errors = _permission_denied_hint(port) + "\n\nOriginal error:\n" + errors
+            return {"success": False, "output": "", "errors": errors}
+        except FileNotFoundError:
+            return {
+                "success": False,
+                "output": "",
+                "errors": "arduino-cli not found. Please install it first."
+            }
+        except asyncio.TimeoutError:
+            return {
+                "success": False,
+                "output": "",
+                "errors": "Compile and upload timed out after 180 seconds."
+            }
+
+
 async def read_serial(port: str, duration: float = 3.0, baudrate: int = 9600) -> str:
     """
     Read serial output from Arduino.
@@ -308,35 +678,60 @@ async def read_serial(port: str, duration: float = 3.0, baudrate: int = 9600) ->
     Returns:
         String containing serial output lines
     """
-    if not HAS_SERIAL:
+    serial = _import_serial()
+    if serial is None:
         return "Error: pyserial not installed"
     
-    output_lines = []
+    data = bytearray()
     try:
-        with serial.Serial(port, baudrate, timeout=1) as ser:
+        # Non-blocking port; reads are driven by fd readiness on the event
+        # loop instead of polling in_waiting every 100ms
+        with serial.Serial(port, baudrate, timeout=0) as ser:
+            try:
+                # ASYNC_LOW_LATENCY: have the tty driver push bytes immediately
+                ser.set_low_latency_mode(True)
+            except (AttributeError, NotImplementedError, OSError, ValueError):
+                pass  # not supported by this driver/platform
+
             # Wait for Arduino to reset after connection
             await asyncio.sleep(2)
-            
-            end_time = asyncio.get_event_loop().time() + duration
-            while asyncio.get_event_loop().time() < end_time:
-                if ser.in_waiting:
-                    try:
-                        line = ser.readline().decode("utf-8", errors="ignore").strip()
-                        if line:
-                            output_lines.append(line)
-                    except Exception:
-                        pass
-                await asyncio.sleep(0.1)
-                
+
+            loop = asyncio.get_running_loop()
+            fd = ser.fileno()
+            finished = loop.create_future()
+
+            def on_readable():
+                try:
+                    # Drain the whole burst in one read, not byte by byte
+                    data.extend(ser.read(ser.in_waiting or 1))
+                except Exception as e:
+                    # Device went away; stop watching the fd
+                    loop.remove_reader(fd)
+                    if not finished.done():
+                        finished.set_exception(e)
+
+            loop.add_reader(fd, on_readable)
+            try:
+                await asyncio.wait({finished}, timeout=duration)
+            finally:
+                loop.remove_reader(fd)
+            if finished.done():
+                finished.result()  # re-raise a read error
+
     except serial.SerialException as e:
         return f"Serial error: {e}"
     except Exception as e:
         return f"Error reading serial: {e}"
-    
+
+    output_lines = [
+        line.strip()
+        for line in data.decode("utf-8", errors="ignore").splitlines()
+        if line.strip()
+    ]
     return "\n".join(output_lines) if output_lines else "No serial output received"
 
 
-def deploy_code(code: str, port: str, name: str = "quick_deploy", fqbn: str = "arduino:avr:uno") -> dict:
+async def deploy_code(code: str, port: str, name: str = "quick_deploy", fqbn: str = "arduino:avr:uno") -> dict:
     """
     Complete deployment pipeline: write, compile, and upload.
     
@@ -351,12 +746,12 @@ def deploy_code(code: str, port: str, name: str = "quick_deploy", fqbn: str = "a
     """
     # Step 1: Write
     try:
-        sketch_path = write_sketch(code, name)
+        sketch_path = await asyncio.to_thread(write_sketch, code, name)
     except Exception as e:
         return {"success": False, "stage": "write", "error": str(e)}
     
     # Step 2: Compile
-    compile_result = compile_sketch(sketch_path, fqbn)
+    compile_result = await compile_sketch(sketch_path, fqbn)
     if not compile_result["success"]:
         return {
             "success": False, 
@@ -366,7 +761,7 @@ def deploy_code(code: str, port: str, name: str = "quick_deploy", fqbn: str = "a
         }
     
     # Step 3: Upload
-    upload_result = upload_sketch(sketch_path, port, fqbn)
+    upload_result = await upload_sketch(sketch_path, port, fqbn)
     if not upload_result["success"]:
         return {
             "success": False, 
@@ -421,7 +816,7 @@ if __name__ == "__main__":
         
         # Test compilation (if board found)
         if boards:
-            result = compile_sketch(path)
+            result = asyncio.run(compile_sketch(path))
             print(f"3. Compilation: {'PASS' if result['success'] else 'FAIL'}")
             if not result['success']:
                 print(f"   Error: {result['errors']}")
@@ -12,16 +12,17 @@ Usage:
     uv run main.py serve --port 8000  # Server mode for custom frontend
 """
 
-import json
+import asyncio
 import logging
 import os
 import time
+from collections import deque
+from dataclasses import dataclass
 from typing import Optional
-import jwt
-from datetime import datetime
 from dotenv import load_dotenv
+import orjson
 from fastapi import HTTPException, Request
-from pydantic import BaseModel
+from pydantic import BaseModel, TypeAdapter, ValidationError
 
 from vision_agents.core import Agent, AgentLauncher, User, Runner
 from vision_agents.plugins import getstream, gemini, deepgram, nvidia, openai
@@ -34,6 +35,7 @@ from arduino_tools import (
     upload_sketch,
     read_serial,
 )
+from stream_tokens import encode_jwt, hs256_key
 
 load_dotenv()
 
@@ -45,8 +47,37 @@ logging.basicConfig(
 )
 logger = logging.getLogger("arduinovision")
 
-# Store tool calls for debugging (accessible via events)
-tool_call_history: list[dict] = []
+# Store tool calls for debugging (accessible via events); capped so a
+# long-running server doesn't keep every sketch it was ever sent
+# Entries carry "timestamp_ns" (time.time_ns()); convert to ISO only when read
+TOOL_HISTORY_MAX = 1000
+tool_call_history: deque[dict] = deque(maxlen=TOOL_HISTORY_MAX)
+
+# Serializes board scans so a burst of list_boards / /boards / /upload calls
+# triggers one arduino-cli run; the rest hit list_arduino_boards' TTL cache
+_boards_lock = asyncio.Lock()
+# Last board list and its port -> board index, rebuilt only when the list changes
+_boards_index: tuple[list[dict], dict[str, dict]] = ([], {})
+
+
+def _log_cli_line(line: str) -> None:
+    """Surface arduino-cli output live while a compile/upload tool runs."""
+    logger.info(f"   │ {line}")
+
+
+async def _get_boards_cached() -> tuple[list[dict], dict[str, dict]]:
+    """
+    List boards off the event loop, coalescing concurrent refreshes.
+
+    Returns:
+        Tuple of (boards, boards keyed by port)
+    """
+    global _boards_index
+    async with _boards_lock:
+        boards = await asyncio.to_thread(list_arduino_boards)
+        if boards is not _boards_index[0]:
+            _boards_index = (boards, {b["port"]: b for b in boards})
+        return _boards_index
 
 # System prompt for the Arduino debugging agent
 SYSTEM_PROMPT = """You are ArduinoVision, an AI assistant specialized in debugging Arduino and IoT projects.
@@ -63,6 +94,7 @@ You have access to these tools - USE THEM when needed:
 - list_boards: Detect connected Arduino boards (ALWAYS call this first to find the port)
 - write_code: Write Arduino sketch code to a file
 - compile_code: Compile the Arduino sketch  
+- compile_many: Compile several candidate sketches in parallel and compare results
 - upload_code: Upload compiled sketch to Arduino
 - read_serial: Read serial output from Arduino for debugging
 - deploy_code: One-step write + compile + upload (convenience)
@@ -107,6 +139,147 @@ When a user reports an issue:
 """
 
 
+# ── Deploy pipeline ────────────────────────────────────────────────────────
+
+UPLOAD_ATTEMPTS = 3  # retries back off 1s, 2s
+# Upload failures that retrying won't fix (see arduino_tools.upload_sketch);
+# anything else, e.g. avrdude losing sync while the board resets, is retried
+_UPLOAD_FATAL_PREFIXES = ("Permission denied", "arduino-cli not found", "Upload timed out")
+
+
+@dataclass
+class _DeployJob:
+    code: str
+    sketch_name: str
+    port: str
+    fqbn: str
+    future: asyncio.Future
+    path: str = ""
+
+
+class DeployPipeline:
+    """
+    write -> compile -> upload stages connected by single-slot queues.
+
+    While one sketch uploads, the next one can already be written and
+    compiled, so back-to-back deploys cost about max(compile, upload) each
+    instead of compile + upload. Jobs for the same sketch name share a
+    sketch folder and build directory, so a job whose name is already in
+    flight is parked and handed to the writer once that one finishes;
+    jobs for other names keep flowing past it.
+    """
+
+    def __init__(self):
+        self._tasks: list[asyncio.Task] = []
+        self._handoffs: set[asyncio.Task] = set()
+
+    def _start(self) -> None:
+        """(Re)create the stage queues and start one consumer task per stage."""
+        # A dead stage means the others are orphaned too; stop them so they
+        # don't keep consuming alongside the new set
+        for task in (*self._tasks, *self._handoffs):
+            task.cancel()
+        self._write_q: asyncio.Queue[_DeployJob] = asyncio.Queue(maxsize=1)
+        self._compile_q: asyncio.Queue[_DeployJob] = asyncio.Queue(maxsize=1)
+        self._upload_q: asyncio.Queue[_DeployJob] = asyncio.Queue(maxsize=1)
+        # Sketch names in flight -> jobs for the same name parked behind it
+        self._busy: dict[str, deque[_DeployJob]] = {}
+        self._handoffs = set()
+        self._tasks = [
+            asyncio.create_task(self._writer()),
+            asyncio.create_task(self._compiler()),
+            asyncio.create_task(self._uploader()),
+        ]
+
+    async def submit(self, code: str, sketch_name: str, port: str, fqbn: str) -> dict:
+        """Queue a deploy and wait for its result (same shape as deploy_code's)."""
+        if not self._tasks or any(t.done() for t in self._tasks):
+            self._start()
+        job = _DeployJob(code, sketch_name, port, fqbn, asyncio.get_running_loop().create_future())
+        await self._write_q.put(job)
+        return await job.future
+
+    def _finish(self, job: _DeployJob, result: dict) -> None:
+        if not job.future.done():
+            job.future.set_result(result)
+        # Hand the sketch name to the next live job parked on it, if any
+        parked = self._busy[job.sketch_name]
+        while parked and parked[0].future.cancelled():
+            parked.popleft()
+        if not parked:
+            del self._busy[job.sketch_name]
+            return
+        task = asyncio.create_task(self._write(parked.popleft()))
+        self._handoffs.add(task)
+        task.add_done_callback(self._handoffs.discard)
+
+    async def _writer(self) -> None:
+        while True:
+            job = await self._write_q.get()
+            if job.future.cancelled():
+                continue
+            parked = self._busy.get(job.sketch_name)
+            if parked is not None:
+                parked.append(job)
+                continue
+            self._busy[job.sketch_name] = deque()
+            await self._write(job)
+
+    async def _write(self, job: _DeployJob) -> None:
+        try:
+            job.path = await asyncio.to_thread(write_sketch, job.code, job.sketch_name)
+        except Exception as e:
+            self._finish(job, {"success": False, "stage": "write", "error": str(e)})
+            return
+        await self._compile_q.put(job)
+
+    async def _compiler(self) -> None:
+        while True:
+            job = await self._compile_q.get()
+            if job.future.cancelled():
+                self._finish(job, {})
+                continue
+            try:
+                result = await compile_sketch(job.path, job.fqbn)
+            except Exception as e:
+                result = {"success": False, "errors": str(e)}
+            if not result["success"]:
+                self._finish(job, {"success": False, "stage": "compile", "error": result["errors"]})
+                continue
+            await self._upload_q.put(job)
+
+    async def _uploader(self) -> None:
+        while True:
+            job = await self._upload_q.get()
+            if job.future.cancelled():
+                self._finish(job, {})
+                continue
+            try:
+                result = await self._upload_with_retry(job)
+            except Exception as e:
+                result = {"success": False, "errors": str(e)}
+            if not result["success"]:
+                self._finish(job, {"success": False, "stage": "upload", "error": result["errors"]})
+                continue
+            self._finish(job, {"success": True, "sketch_path": job.path})
+
+    async def _upload_with_retry(self, job: _DeployJob) -> dict:
+        """Upload with exponential backoff (1s, 2s, ...) between attempts."""
+        for attempt in range(UPLOAD_ATTEMPTS):
+            result = await upload_sketch(job.path, job.port, job.fqbn)
+            # Permission problems, a missing arduino-cli or a 60s timeout
+            # won't fix themselves; don't wait them out
+            if result["success"] or (result["errors"] or "").startswith(_UPLOAD_FATAL_PREFIXES):
+                return result
+            if attempt < UPLOAD_ATTEMPTS - 1:
+                logger.warning(f"⚠️ Upload attempt {attempt + 1} failed, retrying")
+                await asyncio.sleep(2 ** attempt)
+        return result
+
+
+deploy_pipeline = DeployPipeline()
+
+
 async def create_agent(**kwargs) -> Agent:
     """Create the ArduinoVision agent with registered tools."""
     
@@ -118,7 +291,7 @@ async def create_agent(**kwargs) -> Agent:
     )
     async def list_boards() -> dict:
         """Detect connected Arduino boards."""
-        boards = list_arduino_boards()
+        boards, _ = await _get_boards_cached()
         logger.info(f"🔍 list_boards found {len(boards)} board(s)")
         if boards:
             return {
@@ -140,7 +313,7 @@ async def create_agent(**kwargs) -> Agent:
     async def write_code(code: str, sketch_name: str = "debug_sketch") -> dict:
         """Write Arduino code to a file."""
         try:
-            path = write_sketch(code, sketch_name)
+            path = await asyncio.to_thread(write_sketch, code, sketch_name)
             logger.info(f"📝 write_code saved to {path}")
             return {
                 "success": True,
@@ -157,20 +330,44 @@ async def create_agent(**kwargs) -> Agent:
     async def compile_code(sketch_path: str, board_fqbn: str = "arduino:avr:uno") -> dict:
         """Compile an Arduino sketch."""
         logger.info(f"🔨 compile_code: {sketch_path} for {board_fqbn}")
-        result = compile_sketch(sketch_path, board_fqbn)
+        result = await compile_sketch(sketch_path, board_fqbn, on_line=_log_cli_line)
         if result["success"]:
             logger.info("✅ Compilation successful")
             return {"success": True, "message": "Compilation successful!"}
         logger.error(f"❌ Compilation failed: {result['errors']}")
         return {"success": False, "message": "Compilation failed", "errors": result["errors"]}
     
+    @llm.register_function(
+        description="Compile several sketches in parallel (e.g. alternative fixes) and return each one's result. Faster than calling compile_code repeatedly."
+    )
+    async def compile_many(sketch_paths: list[str], board_fqbn: str = "arduino:avr:uno") -> dict:
+        """Compile multiple sketches concurrently, splitting the cores between them."""
+        paths = list(dict.fromkeys(sketch_paths))  # a repeated path compiles once
+        logger.info(f"🔨 compile_many: {len(paths)} sketch(es) for {board_fqbn}")
+        # Each arduino-cli gets its share of the cores via --jobs, so the
+        # total stays near one compiler process per core
+        cpus = os.cpu_count() or 1
+        parallel = max(1, min(len(paths), cpus))
+        jobs = max(1, cpus // parallel)
+        limit = asyncio.Semaphore(parallel)
+
+        async def compile_one(path: str) -> dict:
+            async with limit:
+                result = await compile_sketch(path, board_fqbn, jobs=jobs)
+            return {"sketch_path": path, "success": result["success"], "errors": result["errors"]}
+
+        results = await asyncio.gather(*(compile_one(p) for p in paths))
+        ok = sum(r["success"] for r in results)
+        logger.info(f"🔨 compile_many: {ok}/{len(results)} compiled")
+        return {"results": results, "message": f"{ok} of {len(results)} sketch(es) compiled"}
+    
     @llm.register_function(
         description="Upload a compiled sketch to Arduino. Requires sketch_path, port (from list_boards), and board type."
     )
     async def upload_code(sketch_path: str, port: str, board_fqbn: str = "arduino:avr:uno") -> dict:
         """Upload sketch to Arduino."""
         logger.info(f"📤 upload_code: {sketch_path} to {port}")
-        result = upload_sketch(sketch_path, port, board_fqbn)
+        result = await upload_sketch(sketch_path, port, board_fqbn, on_line=_log_cli_line)
         if result["success"]:
             logger.info(f"✅ Upload successful to {port}")
             return {"success": True, "message": f"Code uploaded successfully to {port}!"}
@@ -194,30 +391,16 @@ async def create_agent(**kwargs) -> Agent:
         """Complete deployment: write + compile + upload."""
         logger.info(f"🚀 deploy_code to {port}")
         
-        # Write
-        try:
-            path = write_sketch(code, sketch_name)
-        except Exception as e:
-            logger.error(f"❌ Deploy failed at write: {e}")
-            return {"success": False, "stage": "write", "error": str(e)}
-        
-        # Compile
-        compile_result = compile_sketch(path, board_fqbn)
-        if not compile_result["success"]:
-            logger.error(f"❌ Deploy failed at compile")
-            return {"success": False, "stage": "compile", "error": compile_result["errors"]}
-        
-        # Upload
-        upload_result = upload_sketch(path, port, board_fqbn)
-        if not upload_result["success"]:
-            logger.error(f"❌ Deploy failed at upload")
-            return {"success": False, "stage": "upload", "error": upload_result["errors"]}
+        result = await deploy_pipeline.submit(code, sketch_name, port, board_fqbn)
+        if not result["success"]:
+            logger.error(f"❌ Deploy failed at {result['stage']}: {result['error']}")
+            return result
         
         logger.info("✅ Deploy successful!")
         return {
             "success": True,
             "message": "Code deployed successfully! Check if your hardware is now working.",
-            "sketch_path": path
+            "sketch_path": result["sketch_path"]
         }
     
     # Create the agent with VLM, STT, and TTS
@@ -238,11 +421,17 @@ async def create_agent(**kwargs) -> Agent:
             "event": "start",
             "tool": event.tool_name,
             "args": event.arguments,
-            "timestamp": datetime.now().isoformat(),
+            "timestamp_ns": time.time_ns(),
         }
         tool_call_history.append(tool_entry)
-        logger.info(f"🔧 TOOL START: {event.tool_name}")
-        logger.info(f"   Args: {json.dumps(event.arguments, indent=2) if event.arguments else 'None'}")
+        if logger.isEnabledFor(logging.INFO):
+            # deploy_code args carry a whole sketch; only format when logged
+            args = (
+                orjson.dumps(event.arguments, option=orjson.OPT_INDENT_2, default=str).decode()
+                if event.arguments else "None"
+            )
+            logger.info(f"🔧 TOOL START: {event.tool_name}")
+            logger.info(f"   Args: {args}")
     
     @agent.events.subscribe  
     async def on_tool_end(event: ToolEndEvent):
@@ -252,7 +441,7 @@ async def create_agent(**kwargs) -> Agent:
             "tool": event.tool_name,
             "success": event.success,
             "execution_time_ms": event.execution_time_ms,
-            "timestamp": datetime.now().isoformat(),
+            "timestamp_ns": time.time_ns(),
         }
         if not event.success:
             tool_entry["error"] = event.error
@@ -274,19 +463,33 @@ async def join_call(agent: Agent, call_type: str, call_id: str, **kwargs) -> Non
     call = await agent.create_call(call_type, call_id)
     
     async with agent.join(call):
-        # Initial greeting - the agent will speak this
-        await agent.simple_response(
+        # Initial greeting - the agent will speak this. It runs in the
+        # background so its generation overlaps with waiting on the call.
+        greet_task = asyncio.create_task(agent.simple_response(
             "Hello! I'm ArduinoVision, your AI hardware debugging assistant. "
             "I can see through your camera and help debug Arduino issues. "
             "Show me your setup and tell me what's not working!"
-        )
+        ))
         
         # Wait for the call to end
-        await agent.finish()
+        try:
+            await agent.finish()
+        finally:
+            if not greet_task.done():
+                greet_task.cancel()
+            elif not greet_task.cancelled() and greet_task.exception():
+                logger.error(f"❌ Greeting failed: {greet_task.exception()}")
 
 
 # ── Custom REST endpoints ──────────────────────────────────────────────────
 
+_STREAM_API_KEY = os.getenv("STREAM_API_KEY", "")
+
+# Stream secret read once, with a keyed HMAC that each token copies
+_STREAM_SECRET = os.getenv("STREAM_API_SECRET", "")
+_TOKEN_KEY = hs256_key(_STREAM_SECRET)
+
+
 class TokenRequest(BaseModel):
     user_id: str
 
@@ -302,23 +505,41 @@ class MessageRequest(BaseModel):
     session_id: Optional[str] = None
 
 
+# Request bodies are validated straight from the raw JSON bytes by these
+# prebuilt adapters (pydantic-core), bypassing FastAPI's per-request body
+# parameter handling
+_TOKEN_ADAPTER = TypeAdapter(TokenRequest)
+_UPLOAD_ADAPTER = TypeAdapter(UploadRequest)
+_MESSAGE_ADAPTER = TypeAdapter(MessageRequest)
+
+
+async def _parse_body(request: Request, adapter: TypeAdapter):
+    """Validate the JSON body with `adapter`, answering 422 in FastAPI's error shape (minus the echoed input)."""
+    try:
+        return adapter.validate_json(await request.body())
+    except ValidationError as e:
+        errors = e.errors(include_url=False, include_context=False, include_input=False)
+        for err in errors:
+            err["loc"] = ("body", *err["loc"])  # FastAPI's location prefix
+        raise HTTPException(status_code=422, detail=errors)
+
+
 runner = Runner(AgentLauncher(create_agent=create_agent, join_call=join_call))
 
 
 @runner.fast_api.get("/stream-config")
-def get_stream_config():
+async def get_stream_config():
     """Return the public Stream API key."""
-    api_key = os.getenv("STREAM_API_KEY", "")
-    if not api_key:
+    if not _STREAM_API_KEY:
         raise HTTPException(status_code=500, detail="STREAM_API_KEY not configured in .env")
-    return {"apiKey": api_key}
+    return {"apiKey": _STREAM_API_KEY}
 
 
 @runner.fast_api.post("/token")
-def generate_token(req: TokenRequest):
+async def generate_token(request: Request):
     """Generate a Stream JWT for the given user ID."""
-    secret = os.getenv("STREAM_API_SECRET", "")
-    if not secret:
+    req: TokenRequest = await _parse_body(request, _TOKEN_ADAPTER)
+    if not _STREAM_SECRET:
         raise HTTPException(status_code=500, detail="STREAM_API_SECRET not configured in .env")
     now = int(time.time())
     payload = {
@@ -326,14 +547,14 @@ def generate_token(req: TokenRequest):
         "iat": now,
         "exp": now + 86400,  # 24 hours
     }
-    token = jwt.encode(payload, secret, algorithm="HS256")
+    token = encode_jwt(payload, _TOKEN_KEY)
     return {"token": token, "user_id": req.user_id}
 
 
 @runner.fast_api.get("/boards")
-def get_boards():
+async def get_boards():
     """List connected Arduino boards."""
-    boards = list_arduino_boards()
+    boards, _ = await _get_boards_cached()
     return {
         "boards": [b["port"] for b in boards],
         "details": boards,
@@ -341,26 +562,34 @@ def get_boards():
 
 
 @runner.fast_api.post("/upload")
-async def upload_code_endpoint(req: UploadRequest):
+async def upload_code_endpoint(request: Request):
     """Write, compile, and upload an Arduino sketch from the editor."""
-    from arduino_tools import write_sketch, compile_sketch, upload_sketch
+    req: UploadRequest = await _parse_body(request, _UPLOAD_ADAPTER)
+
+    # Determine FQBN: use provided one, or try to look it up from board details.
+    # The board listing runs concurrently with writing the sketch.
+    fqbn = req.fqbn
+    lookup_fqbn = not fqbn or fqbn == "arduino:avr:uno"
 
     # Write sketch
     try:
-        path = write_sketch(req.code, "editor_sketch")
+        if lookup_fqbn:
+            path, (_, boards_by_port) = await asyncio.gather(
+                asyncio.to_thread(write_sketch, req.code, "editor_sketch"),
+                _get_boards_cached(),
+            )
+        else:
+            path = await asyncio.to_thread(write_sketch, req.code, "editor_sketch")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to write sketch: {e}")
 
-    # Determine FQBN: use provided one, or try to look it up from board details
-    fqbn = req.fqbn
-    if not fqbn or fqbn == "arduino:avr:uno":
-        boards = list_arduino_boards()
-        matched = next((b for b in boards if b["port"] == req.board), None)
+    if lookup_fqbn:
+        matched = boards_by_port.get(req.board)
         if matched and matched.get("fqbn"):
             fqbn = matched["fqbn"]
 
     # Compile
-    compile_result = compile_sketch(path, fqbn)
+    compile_result = await compile_sketch(path, fqbn)
     if not compile_result["success"]:
         return {
             "success": False,
@@ -370,7 +599,7 @@ async def upload_code_endpoint(req: UploadRequest):
         }
 
     # Upload
-    upload_result = upload_sketch(path, req.board, fqbn)
+    upload_result = await upload_sketch(path, req.board, fqbn)
     if not upload_result["success"]:
         return {
             "success": False,
@@ -383,8 +612,9 @@ async def upload_code_endpoint(req: UploadRequest):
 
 
 @runner.fast_api.post("/message")
-async def send_message_to_agent(req: MessageRequest, request: Request):
+async def send_message_to_agent(request: Request):
     """Inject a user text message into the active agent session so it responds via TTS + chat."""
+    req: MessageRequest = await _parse_body(request, _MESSAGE_ADAPTER)
     launcher = request.app.state.launcher
 
     # Find the target session
@@ -392,9 +622,8 @@ async def send_message_to_agent(req: MessageRequest, request: Request):
     if req.session_id:
         session = launcher.get_session(req.session_id)
     if session is None:
-        # Fall back to first active session
-        sessions = list(launcher._sessions.values())
-        session = sessions[0] if sessions else None
+        # Fall back to first active session (without copying all of them)
+        session = next(iter(launcher._sessions.values()), None)
 
     if session is None:
         raise HTTPException(status_code=404, detail="No active agent session")
@@ -404,4 +633,11 @@ async def send_message_to_agent(req: MessageRequest, request: Request):
 
 
 if __name__ == "__main__":
+    # uvloop (installed with uvicorn[standard]) speeds up every async path:
+    # subprocess pipes, the serial fd reader, HTTP and event handling
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass  # e.g. Windows; stay on the default loop
     runner.cli()
@@ -0,0 +1,38 @@
+"""
+Stream user token signing shared by main.py and api_server.py
+
+Stream tokens are HS256 JWTs. They are assembled directly instead of via
+jwt.encode: the header is a constant, the payload is serialized with
+orjson and the HMAC is keyed once per secret, then copied per token.
+"""
+
+import base64
+import hashlib
+import hmac
+
+import orjson
+
+_JWT_HEADER_B64 = b"eyJhbGciOiJIUzI1NiIsInR5cCI6IkpXVCJ9"  # {"alg":"HS256","typ":"JWT"}
+
+
+def _b64url(data: bytes) -> bytes:
+    return base64.urlsafe_b64encode(data).rstrip(b"=")
+
+
+def hs256_key(secret: str) -> hmac.HMAC:
+    """Key an HMAC-SHA256 with the secret once, for encode_jwt to copy."""
+    return hmac.new(secret.encode(), digestmod=hashlib.sha256)
+
+
+def encode_jwt(payload: dict, key: hmac.HMAC) -> str:
+    """
+    Encode and sign an HS256 JWT with a key from hs256_key.
+
+    The token verifies like one from jwt.encode, and is byte-identical for
+    ASCII payloads. Non-ASCII strings differ: orjson writes them as raw
+    UTF-8 where PyJWT escapes them to \\uXXXX.
+    """
+    signing_input = _JWT_HEADER_B64 + b"." + _b64url(orjson.dumps(payload))
+    mac = key.copy()
+    mac.update(signing_input)
+    return (signing_input + b"." + _b64url(mac.digest())).decode()